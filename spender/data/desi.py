@@ -52,6 +52,7 @@ class DESI(Instrument):
         batch_size=1024,
         shuffle=False,
         shuffle_instance=False,
+        **kwargs,
     ):
         """Get a dataloader for batches of spectra
 
@@ -69,6 +70,9 @@ class DESI(Instrument):
             Whether to shuffle the order of the batch files
         shuffle_instance: bool
             Whether to shuffle spectra within each batch
+        **kwargs
+            Additional arguments for :class:`torch.utils.data.DataLoader`,
+            e.g. `num_workers` or `pin_memory`
 
         Returns
         -------
@@ -83,7 +87,7 @@ class DESI(Instrument):
         data = BatchedFilesDataset(
             files, load_fct, shuffle=shuffle, shuffle_instance=shuffle_instance
         )
-        return DataLoader(data, batch_size=batch_size)
+        return DataLoader(data, batch_size=batch_size, **kwargs)
 
     @classmethod
     def list_batches(cls, dir, which=None, tag=None):
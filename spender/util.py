@@ -7,7 +7,7 @@ import GPUtil
 import humanize
 import psutil
 import torch
-from torch.utils.data import IterableDataset
+from torch.utils.data import IterableDataset, get_worker_info
 from torchinterp1d import interp1d
 
 
@@ -43,6 +43,7 @@ class BatchedFilesDataset(IterableDataset):
     for details.
 
     The file list and the items in each loaded file can be shuffled if desired.
+    With multiple loader workers, every worker processes its own subset of files.
 
     Parameters
     ----------
@@ -76,7 +77,12 @@ class BatchedFilesDataset(IterableDataset):
             yield x
 
     def get_stream(self):
-        return chain.from_iterable(map(self.process_data, range(len(self.file_list))))
+        idx = range(len(self.file_list))
+        # split files among DataLoader workers to avoid duplicate spectra
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            idx = idx[worker_info.id :: worker_info.num_workers]
+        return chain.from_iterable(map(self.process_data, idx))
 
     def __iter__(self):
         return self.get_stream()
@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 
 import argparse
-import functools
 import os
 import time
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import chain
 from tqdm import tqdm
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from torch import nn
-from accelerate import Accelerator
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader
 from spender import SpectrumAutoencoder
 from spender.data import desi
-from spender.util import mem_report, resample_to_restframe
+from spender.util import BatchedFilesDataset, mem_report, resample_to_restframe
 
 # allows one to run fp16_train.py from home directory
 import sys;sys.path.insert(1, './')
@@ -24,37 +28,27 @@ def prepare_train(seq,niter=800):
     return seq
 
 def build_ladder(train_sequence):
-    n_iter = sum([item['iteration'] for item in train_sequence])
-
-    ladder = np.zeros(n_iter,dtype='int')
-    n_start = 0
-    for i,mode in enumerate(train_sequence):
-        n_end = n_start+mode['iteration']
-        ladder[n_start:n_end]= i
-        n_start = n_end
-    return ladder
-
-def get_all_parameters(models,instruments):
-    model_params = []
-    # multiple encoders
-    for model in models:
-        model_params += model.encoder.parameters()
-    # 1 decoder
-    model_params += model.decoder.parameters()
+    # index of training mode for every epoch
+    counts = np.fromiter((mode['iteration'] for mode in train_sequence), dtype='int')
+    return np.repeat(np.arange(counts.size), counts)
+
+def get_all_parameters(models,instruments,verbose=True):
+    # multiple encoders, 1 decoder
+    model_params = list(chain(
+        chain.from_iterable(model.encoder.parameters() for model in models),
+        models[0].decoder.parameters()
+    ))
     dicts = [{'params':model_params}]
 
-    n_parameters = sum([p.numel() for p in model_params if p.requires_grad])
+    n_parameters = sum(p.numel() for p in model_params if p.requires_grad)
 
-    instr_params = []
     # instruments
-    for inst in instruments:
-        if inst==None:continue
-        instr_params += inst.parameters()
-        s = [p.numel() for p in inst.parameters()]
+    instr_params = list(chain.from_iterable(inst.parameters() for inst in instruments if inst is not None))
     if instr_params != []:
         dicts.append({'params':instr_params,'lr': 1e-4})
-        n_parameters += sum([p.numel() for p in instr_params if p.requires_grad])
-        print("parameter dict:",dicts[1])
+        n_parameters += sum(p.numel() for p in instr_params if p.requires_grad)
+        if verbose:
+            print("parameter dict:",dicts[1])
     return dicts,n_parameters
 
 def consistency_loss(s, s_aug, individual=False):
@@ -65,22 +59,50 @@ def consistency_loss(s, s_aug, individual=False):
         return x, sim_loss
     return sim_loss.sum()
 
+def _symsig(x, wid):
+    # symmetric double sigmoid: small for |x| < wid/2, approaches 1 beyond
+    # sigmoid(x-wid/2) + sigmoid(-x-wid/2) rewritten with sigmoid(u) = (1+tanh(u/2))/2,
+    # which keeps everything in one elementwise expression for fusion
+    return 1 + 0.5*(torch.tanh(0.5*(x-0.5*wid)) - torch.tanh(0.5*(x+0.5*wid)))
+
+if hasattr(torch, "compile"):
+    _symsig = torch.compile(_symsig, dynamic=True)
+
+@lru_cache(maxsize=4)
+def _triu_indices(batch_size, device):
+    # indices of all distinct pairs (i<j), cached for the recent batch sizes
+    return torch.triu_indices(batch_size, batch_size, offset=1, device=device)
+
+def _pair_matrix(x, i, j, batch_size):
+    # symmetric matrix with zero diagonal from values of the distinct pairs
+    M = torch.zeros((batch_size, batch_size), device=x.device, dtype=x.dtype)
+    M[i, j] = x
+    M[j, i] = x
+    return M
+
 def similarity_loss(instrument, model, spec, w, z, s, slope=0.5, individual=False, wid=5, amp=3):
     spec,w = resample_to_restframe(instrument.wave_obs,
                                    model.decoder.wave_rest,
                                    spec,w,z)
+    # pairwise sums need full precision, also under autocast
+    spec, w, s = spec.float(), w.float(), s.float()
 
     batch_size, spec_size = spec.shape
     _, s_size = s.shape
     device = s.device
 
+    # all dissimilarities are symmetric and zero for i=j:
+    # only evaluate the distinct pairs
+    i, j = _triu_indices(batch_size, device)
+
     # pairwise dissimilarity of spectra
-    S = (spec[None,:,:] - spec[:,None,:])**2
+    S = (spec[i] - spec[j])**2
 
     # pairwise weights
+    # harmonic combination of w_i and w_j does not factorize, so W stays (P,L)
     non_zero = w > 1e-6
-    N = (non_zero[None,:,:] * non_zero[:,None,:])
-    W = (1 / w)[None,:,:] + (1 / w)[:,None,:]
+    N = non_zero[i] * non_zero[j]
+    W = (1 / w)[i] + (1 / w)[j]
     W =  N / W
 
     N = N.sum(-1)
@@ -90,19 +112,17 @@ def similarity_loss(instrument, model, spec, w, z, s, slope=0.5, individual=Fals
     spec_sim = (W * S).sum(-1) / N
 
     # dissimilarity of latents
-    s_sim = ((s[None,:,:] - s[:,None,:])**2).sum(-1) / s_size
+    s_sim = (torch.cdist(s, s).pow(2) / s_size)[i, j]
 
     # only give large loss of (dis)similarities are different (either way)
     x = s_sim-spec_sim
-    sim_loss = torch.sigmoid(slope*x-0.5*wid)+torch.sigmoid(-slope*x-0.5*wid)
-    diag_mask = torch.diag(torch.ones(batch_size,device=device,dtype=bool))
-    sim_loss[diag_mask] = 0
+    sim_loss = _symsig(slope*x, wid)
 
     if individual:
-        return s_sim,spec_sim,sim_loss
-    # total loss: sum over N^2 terms,
+        return tuple(_pair_matrix(m, i, j, batch_size) for m in (s_sim, spec_sim, sim_loss))
+    # total loss: sum over N^2 terms (twice the distinct pairs),
     # needs to have amplitude of N terms to compare to fidelity loss
-    return amp*sim_loss.sum() / batch_size
+    return 2*amp*sim_loss.sum() / batch_size
 
 def restframe_weight(model,mu=5000,sigma=2000,amp=30):
     x = model.decoder.wave_rest
@@ -113,25 +133,39 @@ def similarity_restframe(instrument, model, s=None, slope=1.0,
     _, s_size = s.shape
     device = s.device
 
+    # weights and normalization bins only depend on the fixed wave_rest:
+    # compute them once
+    decoder = model.decoder
+    if not hasattr(decoder, "_rf_weight"):
+        decoder.register_buffer("_rf_weight", restframe_weight(model), persistent=False)
+    if getattr(decoder, "_rf_bound", None) != tuple(bound):
+        wave = decoder.wave_rest
+        mask_idx = ((wave>bound[0]) & (wave<bound[1])).nonzero(as_tuple=True)[0]
+        decoder.register_buffer("_rf_mask_idx", mask_idx, persistent=False)
+        decoder._rf_bound = tuple(bound)
+
     spec = model.decode(s)
-    wave = model.decoder.wave_rest
-    mask = (wave>bound[0])*(wave<bound[1])
-    spec /= spec[:,mask].median(dim=1)[0][:,None]
+    # full precision, see similarity_loss
+    spec, s = spec.float(), s.float()
+    norm = spec.index_select(1, decoder._rf_mask_idx).median(dim=1, keepdim=True).values
+    spec = spec / norm
     batch_size, spec_size = spec.shape
-    # pairwise dissimilarity of spectra
-    S = (spec[None,:,:] - spec[:,None,:])**2
+
+    W = decoder._rf_weight
     # dissimilarity of spectra
     # of order unity, larger for spectrum pairs with more comparable bins
-    W = restframe_weight(model)
-    spec_sim = (W * S).sum(-1) / spec_size
+    # sum_k W_k (x_ik - x_jk)^2 = |sqrt(W) x_i - sqrt(W) x_j|^2,
+    # so cdist avoids forming the (B,B,L) difference tensor
+    spec_w = spec * W.sqrt()
+    spec_sim = torch.cdist(spec_w, spec_w).pow(2) / spec_size
     # dissimilarity of latents
-    s_sim = ((s[None,:,:] - s[:,None,:])**2).sum(-1) / s_size
+    s_sim = torch.cdist(s, s).pow(2) / s_size
 
     # only give large loss of (dis)similarities are different (either way)
     x = s_sim-spec_sim
-    sim_loss = torch.sigmoid(slope*x-wid/2)+torch.sigmoid(-slope*x-wid/2)
+    sim_loss = _symsig(slope*x, wid)
     diag_mask = torch.diag(torch.ones(batch_size,device=device,dtype=bool))
-    sim_loss[diag_mask] = 0
+    sim_loss = sim_loss.masked_fill(diag_mask, 0)
 
     if individual:
         return s_sim,spec_sim,sim_loss
@@ -171,15 +205,16 @@ def get_losses(model,
 
     loss, sim_loss, s = _losses(model, instrument, batch, similarity=similarity, slope=slope)
 
-    if aug_fct is not None:
+    # augmented batch only enters through the consistency loss (scaled by slope)
+    # the skip=True pass doesn't compute the other augmented losses
+    loss_ = sim_loss_ = 0
+    if consistency and aug_fct is not None and slope > 0:
         z_max = 0.8 # Hack, variable not passed.
         batch_copy = aug_fct(batch,z_max=z_max)
-        loss_, sim_loss_, s_ = _losses(model, instrument, batch_copy, similarity=similarity, slope=slope,skip=True)
-    else:
-        loss_ = sim_loss_ = 0
-
-    if consistency and aug_fct is not None:
-        cons_loss = slope*consistency_loss(s, s_)
+        _, _, s_ = _losses(model, instrument, batch_copy, similarity=similarity, slope=slope,skip=True)
+        # stop-gradient on the unaugmented latents (as in SimSiam):
+        # only the augmented pass is pulled towards s
+        cons_loss = slope*consistency_loss(s.detach(), s_)
     else:
         cons_loss = 0
 
@@ -189,19 +224,82 @@ def get_losses(model,
 
     return loss, sim_loss, loss_, sim_loss_, cons_loss
 
-
-def checkpoint(accelerator, args, optimizer, scheduler, n_encoder, outfile, losses):
-    unwrapped = [accelerator.unwrap_model(args_i).state_dict() for args_i in args]
-
-    accelerator.save({
-        "model": unwrapped,
-        "losses": losses,
+class LossModule(nn.Module):
+    """Models and instruments with get_losses as forward
+
+    DDP only synchronizes gradients of computations that run through its
+    forward call, so the full loss evaluation needs to be wrapped.
+    All models are held by one module, so that a shared decoder is only
+    registered (and all-reduced) once.
+    """
+    def __init__(self, models, instruments):
+        super().__init__()
+        self.models = nn.ModuleList(models)
+        self.instruments = nn.ModuleList(instruments)
+
+    def forward(self, which, batch, **kwargs):
+        return get_losses(self.models[which], self.instruments[which], batch, **kwargs)
+
+def init_distributed():
+    # set up process group when launched with torchrun, otherwise single device
+    if "LOCAL_RANK" in os.environ:
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group("nccl")
+        return dist.get_rank(), dist.get_world_size(), torch.device("cuda", local_rank)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return 0, 1, device
+
+def distribute_loader(loader, rank, world_size):
+    # BatchedFilesDataset is iterable and can't use a DistributedSampler:
+    # give every rank its own subset of batch files instead
+    data = loader.dataset
+    files = data.file_list[rank::world_size]
+    if not files:
+        raise ValueError(f"{len(data.file_list)} batch files can't be distributed over {world_size} ranks")
+    data = BatchedFilesDataset(files,
+                               data.load_fct,
+                               shuffle=data.shuffle,
+                               shuffle_instance=data.shuffle_instance)
+    kwargs = {}
+    if loader.num_workers > 0:
+        kwargs = {"prefetch_factor": loader.prefetch_factor,
+                  "persistent_workers": loader.persistent_workers}
+    return DataLoader(data, batch_size=loader.batch_size,
+                      num_workers=loader.num_workers,
+                      pin_memory=loader.pin_memory,
+                      **kwargs)
+
+def to_device(batch, device):
+    # asynchronous copy, overlaps with compute if batch is in pinned memory
+    return [x.to(device, non_blocking=True) for x in batch]
+
+def reduce_loss(loss, n_sample, world_size):
+    # mean loss per sample over all ranks
+    if world_size > 1:
+        n_sample = torch.tensor(n_sample, dtype=loss.dtype, device=loss.device)
+        dist.all_reduce(loss)
+        dist.all_reduce(n_sample)
+    return loss / n_sample
+
+def checkpoint(args, optimizer, scheduler, n_encoder, outfile, losses):
+    torch.save({
+        "model": [args_i.state_dict() for args_i in args],
+        "losses": losses.cpu().numpy(),
     }, outfile)
     return
 
 def load_model(filename, models, instruments):
     device = instruments[0].wave_obs.device
-    model_struct = torch.load(filename, map_location=device)
+    # checkpoints contain the loss history as numpy array: no weights_only
+    try: # memory-map tensor storages instead of reading the whole file
+        model_struct = torch.load(filename, map_location=device, mmap=True, weights_only=False)
+    except TypeError: # PyTorch < 2.1, no mmap (and weights_only=False by default)
+        model_struct = torch.load(filename, map_location=device)
+    except RuntimeError as e: # legacy (non-zipfile) checkpoints can't be memory-mapped
+        if "mmap" not in str(e):
+            raise
+        model_struct = torch.load(filename, map_location=device, weights_only=False)
     #wave_rest = model_struct['model'][0]['decoder.wave_rest']
     for i, model in enumerate(models):
         # backwards compat: encoder.mlp instead of encoder.mlp.mlp
@@ -238,38 +336,59 @@ def train(models,
           ):
 
     n_encoder = len(models)
-    model_parameters, n_parameters = get_all_parameters(models,instruments)
+    rank, world_size, device = init_distributed()
+    verbose = verbose and rank == 0
+
+    models = [model.to(device) for model in models]
+    instruments = [instrument.to(device) for instrument in instruments]
+    model_parameters, n_parameters = get_all_parameters(models,instruments,verbose=rank == 0)
 
     if verbose:
         print("model parameters:", n_parameters)
         mem_report()
 
     ladder = build_ladder(train_sequence)
-    optimizer = torch.optim.Adam(model_parameters, lr=lr, eps=1e-4)
+    # update all parameters with a single fused kernel
+    try:
+        optimizer = torch.optim.Adam(model_parameters, lr=lr, eps=1e-4, fused=device.type == "cuda")
+    except TypeError: # older PyTorch without fused Adam
+        optimizer = torch.optim.Adam(model_parameters, lr=lr, eps=1e-4, foreach=True)
     scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, lr,
                                               total_steps=n_epoch)
 
-    accelerator = Accelerator(mixed_precision='fp16')
-    models = [accelerator.prepare(model) for model in models]
-    instruments = [accelerator.prepare(instrument) for instrument in instruments]
-    trainloaders = [accelerator.prepare(loader) for loader in trainloaders]
-    validloaders = [accelerator.prepare(loader) for loader in validloaders]
-    optimizer = accelerator.prepare(optimizer)
+    loss_model = LossModule(models, instruments)
+    if world_size > 1:
+        # other encoders or frozen parts don't receive gradients in every step
+        partial = n_encoder > 1 or not all(mode['decoder'] and all(mode['encoder']) for mode in train_sequence)
+        # buffers (wavelength grids) are constant: no need to broadcast them every step
+        loss_model = DDP(loss_model, device_ids=[device.index],
+                         gradient_as_bucket_view=True,
+                         broadcast_buffers=False,
+                         find_unused_parameters=partial)
+        trainloaders = [distribute_loader(loader, rank, world_size) for loader in trainloaders]
+        validloaders = [distribute_loader(loader, rank, world_size) for loader in validloaders]
+
+    # mixed precision on GPU: bfloat16 if supported,
+    # otherwise float16, which needs loss scaling
+    use_amp = device.type == "cuda"
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp and amp_dtype == torch.float16)
 
     # define losses to track
     n_loss = 5
     epoch = 0
+    # kept on device, only copied to host for printing and checkpoints
     if losses is None:
-        detailed_loss = np.zeros((2, n_encoder, n_epoch, n_loss))
+        detailed_loss = torch.zeros((2, n_encoder, n_epoch, n_loss), dtype=torch.float64, device=device)
     else:
         try:
             epoch = len(losses[0][0])
             n_epoch += epoch
-            detailed_loss = np.zeros((2, n_encoder, n_epoch, n_loss))
-            detailed_loss[:, :, :epoch, :] = losses
+            detailed_loss = torch.zeros((2, n_encoder, n_epoch, n_loss), dtype=torch.float64, device=device)
+            detailed_loss[:, :, :epoch, :] = torch.as_tensor(losses, dtype=detailed_loss.dtype, device=device)
             if verbose:
-                losses = tuple(detailed_loss[0, :, epoch-1, :])
-                vlosses = tuple(detailed_loss[1, :, epoch-1, :])
+                losses = tuple(detailed_loss[0, :, epoch-1, :].cpu().numpy())
+                vlosses = tuple(detailed_loss[1, :, epoch-1, :].cpu().numpy())
                 print(f'====> Epoch: {epoch-1}')
                 print('TRAINING Losses:', losses)
                 print('VALIDATION Losses:', vlosses)
@@ -279,13 +398,18 @@ def train(models,
     if outfile is None:
         outfile = "checkpoint.pt"
 
+    # only toggle requires_grad when the training mode changes
+    last_mode = None
+    last_encoder_mode = [None] * n_encoder
     for epoch_ in range(epoch, n_epoch):
 
         mode = train_sequence[ladder[epoch_ - epoch]]
 
         # turn on/off model decoder
-        for p in models[0].decoder.parameters():
-            p.requires_grad = mode['decoder']
+        if mode is not last_mode:
+            for p in models[0].decoder.parameters():
+                p.requires_grad = mode['decoder']
+            last_mode = mode
 
         slope = ANNEAL_SCHEDULE[(epoch_ - epoch)%len(ANNEAL_SCHEDULE)]
         if n_epoch-epoch_<=10: slope=0 # turn off similarity
@@ -296,8 +420,10 @@ def train(models,
         for which in range(n_encoder):
 
             # turn on/off encoder
-            for p in models[which].encoder.parameters():
-                p.requires_grad = mode['encoder'][which]
+            if mode['encoder'][which] != last_encoder_mode[which]:
+                for p in models[which].encoder.parameters():
+                    p.requires_grad = mode['encoder'][which]
+                last_encoder_mode[which] = mode['encoder'][which]
 
             # optional: training on single dataset
             if not mode['data'][which]:
@@ -307,34 +433,44 @@ def train(models,
             instruments[which].train()
 
             n_sample = 0
-            for k, batch in tqdm(enumerate(trainloaders[which])):
-                batch_size = len(batch[0])
-                losses = get_losses(
-                    models[which],
-                    instruments[which],
-                    batch,
-                    aug_fct=aug_fcts[which],
-                    similarity=similarity,
-                    consistency=consistency,
-                    slope=slope,
-                )
-                # sum up all losses
-                loss = functools.reduce(lambda a, b: a+b , losses)
-                accelerator.backward(loss)
-                # clip gradients: stabilizes training with similarity
-                accelerator.clip_grad_norm_(model_parameters[0]['params'], 1.0)
-                # once per batch
-                optimizer.step()
-                optimizer.zero_grad()
-
-                # logging: training
-                detailed_loss[0][which][epoch_] += tuple( l.item() if hasattr(l, 'item') else 0 for l in losses )
-                n_sample += batch_size
-
-                # stop after n_batch
-                if n_batch is not None and k == n_batch - 1:
-                    break
-            detailed_loss[0][which][epoch_] /= n_sample
+            # accumulate on device, avoids a host sync per batch
+            train_loss = torch.zeros(n_loss, device=device)
+            # ranks can run out of batches at different steps:
+            # join shadows the collectives of those that finished early
+            with loss_model.join() if world_size > 1 else nullcontext():
+                for k, batch in tqdm(enumerate(trainloaders[which]), disable=rank != 0):
+                    batch_size = len(batch[0])
+                    batch = to_device(batch, device)
+                    with torch.amp.autocast("cuda", enabled=use_amp, dtype=amp_dtype):
+                        losses = loss_model(
+                            which,
+                            batch,
+                            aug_fct=aug_fcts[which],
+                            similarity=similarity,
+                            consistency=consistency,
+                            slope=slope,
+                        )
+                    # sum up all losses, skipping the unused ones (= 0)
+                    loss = torch.stack([l for l in losses if torch.is_tensor(l)]).sum()
+                    scaler.scale(loss).backward()
+                    # clip gradients: stabilizes training with similarity
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model_parameters[0]['params'], 1.0)
+                    # once per batch
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+
+                    # logging: training
+                    for i, l in enumerate(losses):
+                        if torch.is_tensor(l):
+                            train_loss[i] += l.detach()
+                    n_sample += batch_size
+
+                    # stop after n_batch
+                    if n_batch is not None and k == n_batch - 1:
+                        break
+            detailed_loss[0][which][epoch_] = reduce_loss(train_loss, n_sample, world_size)
 
         scheduler.step()
 
@@ -344,38 +480,46 @@ def train(models,
                 instruments[which].eval()
 
                 n_sample = 0
+                valid_loss = torch.zeros(n_loss, device=device)
                 for k, batch in enumerate(validloaders[which]):
                     batch_size = len(batch[0])
-                    losses = get_losses(
-                        models[which],
-                        instruments[which],
-                        batch,
-                        aug_fct=aug_fcts[which],
-                        similarity=similarity,
-                        consistency=consistency,
-                        slope=slope,
-                    )
+                    batch = to_device(batch, device)
+                    with torch.amp.autocast("cuda", enabled=use_amp, dtype=amp_dtype):
+                        losses = get_losses(
+                            models[which],
+                            instruments[which],
+                            batch,
+                            aug_fct=aug_fcts[which],
+                            similarity=similarity,
+                            consistency=consistency,
+                            slope=slope,
+                        )
                     # logging: validation
-                    detailed_loss[1][which][epoch_] += tuple( l.item() if hasattr(l, 'item') else 0 for l in losses )
+                    for i, l in enumerate(losses):
+                        if torch.is_tensor(l):
+                            valid_loss[i] += l
                     n_sample += batch_size
 
                     # stop after n_batch
                     if n_batch is not None and k == n_batch - 1:
                         break
 
-                detailed_loss[1][which][epoch_] /= n_sample
+                detailed_loss[1][which][epoch_] = reduce_loss(valid_loss, n_sample, world_size)
 
         if verbose:
             mem_report()
-            losses = tuple(detailed_loss[0, :, epoch_, :])
-            vlosses = tuple(detailed_loss[1, :, epoch_, :])
+            losses = tuple(detailed_loss[0, :, epoch_, :].cpu().numpy())
+            vlosses = tuple(detailed_loss[1, :, epoch_, :].cpu().numpy())
             print('====> Epoch: %i'%(epoch))
             print('TRAINING Losses:', losses)
             print('VALIDATION Losses:', vlosses)
 
-        if epoch_ % 5 == 0 or epoch_ == n_epoch - 1:
+        if rank == 0 and (epoch_ % 5 == 0 or epoch_ == n_epoch - 1):
             args = models
-            checkpoint(accelerator, args, optimizer, scheduler, n_encoder, outfile, detailed_loss)
+            checkpoint(args, optimizer, scheduler, n_encoder, outfile, detailed_loss)
+
+    if world_size > 1:
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
@@ -398,6 +542,7 @@ if __name__ == "__main__":
     # define instruments
     instruments = [ desi.DESI() ]
     n_encoder = len(instruments)
+    device = instruments[0].wave_obs.device
 
     # restframe wavelength for reconstructed spectra
     # Note: represents joint dataset wavelength range
@@ -409,14 +554,22 @@ if __name__ == "__main__":
         lmbda_min = instruments[0].wave_obs[0]/(1.0+args.z_max)
         lmbda_max = instruments[0].wave_obs[-1]/(1.0-args.z_max)
         bins = int((lmbda_max-lmbda_min).item()/0.8)
-    wave_rest = torch.linspace(lmbda_min, lmbda_max, bins, dtype=torch.float32)
+    lmbda_min, lmbda_max = lmbda_min.item(), lmbda_max.item()
+    wave_rest = torch.linspace(lmbda_min, lmbda_max, bins, device=device, dtype=torch.float32)
     
     if args.verbose:
         print ("Restframe:\t{:.0f} .. {:.0f} A ({} bins)".format(lmbda_min, lmbda_max, bins))
 
     # data loaders
-    trainloaders = [ inst.get_data_loader(args.dir, tag="Stars", which="train",  batch_size=args.batch_size, shuffle=True, shuffle_instance=True) for inst in instruments ]
-    validloaders = [ inst.get_data_loader(args.dir,  tag="Stars", which="valid", batch_size=args.batch_size, shuffle=True, shuffle_instance=True) for inst in instruments ]
+    # parallel loading, pinned memory only with CUDA
+    # half of the CPUs for loading, shared by all processes on this node
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    loader_kwargs = {"num_workers": max(1, os.cpu_count() // (2 * local_world_size)),
+                     "prefetch_factor": 4,
+                     "pin_memory": torch.cuda.is_available()}
+    # validation is short (and stopped after n_batch): no need to keep its workers
+    trainloaders = [ inst.get_data_loader(args.dir, tag="Stars", which="train",  batch_size=args.batch_size, shuffle=True, shuffle_instance=True, persistent_workers=True, **loader_kwargs) for inst in instruments ]
+    validloaders = [ inst.get_data_loader(args.dir,  tag="Stars", which="valid", batch_size=args.batch_size, shuffle=True, shuffle_instance=True, persistent_workers=False, **loader_kwargs) for inst in instruments ]
 
     # get augmentation function
     if args.augmentation: